@@ -1,18 +1,93 @@
-from fastapi import FastAPI, Request, HTTPException
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import hmac
+import io
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 import httpx
+import orjson
 import os
-from typing import Any, Dict, List, Tuple
+import random
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple, TypeVar
+import uuid
 
 import boto3
 from botocore.client import Config
-from urllib.parse import urlparse
-import os as _os
+from botocore.exceptions import ClientError
+from cachetools import TTLCache
+from urllib.parse import quote
 
 # -------------------------------------------------
 #  Configuração
 # -------------------------------------------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Um único cliente HTTP para toda a vida da app: reaproveita ligações
+    # (keep-alive) em vez de abrir TCP+TLS novo em cada pedido. Com HTTP/2
+    # os pedidos em paralelo partilham a mesma ligação.
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+
+    # Abre já a ligação ao Linear e confirma o protocolo negociado
+    try:
+        resp = await app.state.http.get(LINEAR_API_URL)
+        print(f"[INFO] Ligação ao Linear em {resp.http_version}")
+    except httpx.HTTPError as e:
+        print(f"[WARN] Não foi possível contactar o Linear no arranque: {e}")
+
+    # Valida a configuração do R2 e aquece o cliente boto3 (assinatura,
+    # endpoint, pool de ligações) antes do primeiro webhook
+    app.state.r2 = None
+    # Threads dedicadas às chamadas (bloqueantes) do boto3, dimensionadas
+    # para o máximo de chamadas R2 em simultâneo
+    app.state.r2_executor = ThreadPoolExecutor(
+        max_workers=R2_MAX_CONCURRENT_CALLS,
+        thread_name_prefix="r2",
+    )
+    if R2_CONFIG_OK:
+        # Cliente S3 compatível com R2 (criado no arranque, não no import)
+        app.state.r2 = boto3.client(
+            "s3",
+            endpoint_url=f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com",
+            aws_access_key_id=R2_ACCESS_KEY_ID,
+            aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=R2_MAX_CONCURRENT_CALLS,
+                # as retentativas do R2 (5xx, throttling, ligação) ficam só
+                # no botocore; o with_retry é apenas para o Linear/Bitrix
+                retries={"mode": "standard", "max_attempts": RETRY_ATTEMPTS},
+                connect_timeout=R2_CONNECT_TIMEOUT,
+                read_timeout=R2_READ_TIMEOUT,
+            ),
+            region_name="auto",
+        )
+        try:
+            # com prazo curto: um R2 inacessível não pode atrasar o arranque
+            await asyncio.wait_for(
+                run_r2(app.state.r2.head_bucket, Bucket=R2_BUCKET_NAME),
+                timeout=R2_WARMUP_TIMEOUT,
+            )
+        except Exception as e:
+            print(f"[WARN] Não foi possível contactar o bucket R2 no arranque: {e!r}")
+    else:
+        print("[WARN] Configuração R2 incompleta; anexos não serão copiados.")
+
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        app.state.r2_executor.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Linear
 LINEAR_API_URL = "https://api.linear.app/graphql"
@@ -30,23 +105,130 @@ R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
 R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
 # ex.: https://pub-xxxxxx.r2.dev
 R2_PUBLIC_BASE_URL = os.getenv("R2_PUBLIC_BASE_URL")
+# validado uma vez no arranque, em vez de em cada upload
+R2_CONFIG_OK = all([R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_ACCOUNT_ID, R2_BUCKET_NAME, R2_PUBLIC_BASE_URL])
+
+# Máximo de comandos por pedido batch do Bitrix
+BITRIX_BATCH_LIMIT = 50
+
+# Prazo total (segundos) para copiar os anexos antes de criar a issue
+ATTACHMENT_COPY_DEADLINE = 120
 
-# Cliente S3 compatível com R2
-r2_client = boto3.client(
-    "s3",
-    endpoint_url=f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com",
-    aws_access_key_id=R2_ACCESS_KEY_ID,
-    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-    config=Config(signature_version="s3v4"),
-    region_name="auto",
-)
+# Máximo de anexos a copiar em simultâneo (Bitrix -> R2)
+ATTACHMENT_CONCURRENCY = 8
+attachment_semaphore = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+
+# Upload multipart para o R2: tamanho de cada parte e máximo de partes
+# em memória/a enviar em simultâneo, somando todos os ficheiros.
+# Pior caso de memória: R2_MAX_PARTS_IN_FLIGHT partes + um buffer (< 1 parte)
+# por ficheiro em cópia, ~ (4 + 8) x 8 MB, dentro dos 512 MB do plano free.
+R2_PART_SIZE = 8 * 1024 * 1024
+R2_MAX_PARTS_IN_FLIGHT = 4
+r2_parts_semaphore = asyncio.Semaphore(R2_MAX_PARTS_IN_FLIGHT)
+
+# Timeouts (segundos) do cliente R2 e prazo do aquecimento no arranque
+R2_CONNECT_TIMEOUT = 5
+R2_READ_TIMEOUT = 60
+R2_WARMUP_TIMEOUT = 5
+
+# Chamadas R2 em simultâneo: uma por ficheiro + as partes multipart
+# (tamanho do executor e do pool de ligações do boto3)
+R2_MAX_CONCURRENT_CALLS = ATTACHMENT_CONCURRENCY + R2_MAX_PARTS_IN_FLIGHT
+
+# Validade (segundos) dos URLs pré-assinados para upload direto no R2
+R2_PRESIGN_EXPIRES = 900
+# Segredo partilhado exigido em /attachments/presign (header X-Presign-Token)
+PRESIGN_TOKEN = os.getenv("PRESIGN_TOKEN")
+
+# Retentativas (429 e erros 5xx): with_retry para Linear/Bitrix, botocore para o R2
+RETRY_ATTEMPTS = 3
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Cache email (casefold) -> id de utilizador do Linear (10 min)
+USER_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=600)
+# as falhas também ficam em cache (None), por isso o "não está" é um sentinela
+_MISSING = object()
+_user_locks: Dict[str, asyncio.Lock] = {}
+
+# Webhooks já recebidos (hash do corpo), para ignorar reenvios do Bitrix
+SEEN_WEBHOOKS: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+
+
+# -------------------------------------------------
+#  Retentativas
+# -------------------------------------------------
+
+T = TypeVar("T")
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """Erros temporários (rate limit, 5xx, falhas de ligação) que vale a pena repetir."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRYABLE_STATUS
+    if isinstance(e, httpx.TransportError):
+        return True
+    return False
+
+
+def is_retryable_mutation_error(e: Exception) -> bool:
+    """
+    Erros em que temos a certeza de que a mutação não foi aplicada
+    (429 ou falha ao estabelecer a ligação). Um 5xx ou timeout de leitura
+    pode chegar depois de o Linear ter criado a issue, por isso não repete.
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429
+    return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+async def with_retry(
+    factory: Callable[[], Awaitable[T]],
+    attempts: int = RETRY_ATTEMPTS,
+    retryable: Callable[[Exception], bool] = is_retryable_error,
+) -> T:
+    """
+    Executa factory() e repete em caso de erro temporário,
+    com backoff exponencial (1s, 2s, ...) e jitter.
+    """
+    for attempt in range(attempts):
+        try:
+            return await factory()
+        except Exception as e:
+            if attempt == attempts - 1 or not retryable(e):
+                raise
+            await asyncio.sleep(2 ** attempt + random.random())
+
+    raise RuntimeError("unreachable")
 
 
 # -------------------------------------------------
 #  Helpers Linear
 # -------------------------------------------------
 
-async def linear_request(query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+# Queries GraphQL estáticas (com nome de operação) definidas uma só vez
+QUERY_USER_BY_EMAIL = """
+query UserByEmail($email: String!) {
+  users(first: 1, filter: { email: { eqIgnoreCase: $email } }) {
+    nodes { id }
+  }
+}
+"""
+
+MUT_ISSUE_CREATE = """
+mutation CreateIssue($input: IssueCreateInput!) {
+  issueCreate(input: $input) {
+    success
+    issue { id identifier title url }
+  }
+}
+"""
+
+
+async def linear_request(
+    query: str,
+    variables: Dict[str, Any],
+    operation_name: str | None = None,
+) -> Dict[str, Any]:
     """Envia um pedido GraphQL para o Linear."""
     if not LINEAR_API_KEY:
         raise HTTPException(500, "Falta LINEAR_API_KEY")
@@ -57,15 +239,19 @@ async def linear_request(query: str, variables: Dict[str, Any]) -> Dict[str, Any
         "Content-Type": "application/json",
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.post(
-            LINEAR_API_URL,
-            json={"query": query, "variables": variables},
-            headers=headers,
-        )
+    body: Dict[str, Any] = {"query": query, "variables": variables}
+    if operation_name:
+        body["operationName"] = operation_name
+
+    client: httpx.AsyncClient = app.state.http
+    resp = await client.post(LINEAR_API_URL, content=orjson.dumps(body), headers=headers)
+
+    # rate limit / indisponibilidade: deixa o with_retry tentar de novo
+    if resp.status_code in RETRYABLE_STATUS:
+        resp.raise_for_status()
 
     try:
-        data = resp.json()
+        data = orjson.loads(resp.content)
     except Exception:
         raise HTTPException(
             502,
@@ -83,117 +269,336 @@ async def get_user_id_by_email(email: str | None) -> str | None:
     if not email:
         return None
 
-    query = """
-    {
-      users(first: 200) {
-        nodes { id email }
-      }
-    }
-    """
-
-    data = await linear_request(query, {})
-    users = (data.get("users") or {}).get("nodes") or []
-
-    email_lower = email.lower()
-    for u in users:
-        if (u.get("email") or "").lower() == email_lower:
-            return u.get("id")
-
-    return None
+    # casefold() só para a chave da cache; ao Linear vai o email original
+    key = email.strip().casefold()
+    hit = USER_CACHE.get(key, _MISSING)
+    if hit is not _MISSING:
+        return hit
+
+    # Um lock por email evita vários pedidos iguais ao Linear em simultâneo
+    lock = _user_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        hit = USER_CACHE.get(key, _MISSING)
+        if hit is not _MISSING:
+            return hit
+
+        try:
+            data = await with_retry(
+                lambda: linear_request(QUERY_USER_BY_EMAIL, {"email": email.strip()}, "UserByEmail")
+            )
+            users = (data.get("users") or {}).get("nodes") or []
+
+            user_id = users[0].get("id") if users else None
+            USER_CACHE[key] = user_id
+            return user_id
+        finally:
+            # não remover um lock mais recente criado por outro pedido
+            if _user_locks.get(key) is lock:
+                del _user_locks[key]
 
 
 # -------------------------------------------------
 #  Helpers Bitrix
 # -------------------------------------------------
 
-async def download_bitrix_file(file_id: int) -> Tuple[bytes, str, str]:
+async def get_bitrix_files_info(file_ids: List[int]) -> List[Tuple[int, str, str]]:
     """
-    Faz download de um ficheiro do Bitrix usando disk.file.get + DOWNLOAD_URL.
-    Devolve (bytes, content_type, filename).
+    Busca os metadados de vários ficheiros do Bitrix de uma vez
+    (batch + disk.file.get, até 50 comandos por pedido).
+    Devolve [(file_id, download_url, filename)] dos ficheiros com DOWNLOAD_URL.
     """
     if not BITRIX_WEBHOOK_BASE:
         raise HTTPException(500, "Falta BITRIX_WEBHOOK_BASE")
 
     base = BITRIX_WEBHOOK_BASE.rstrip("/")
+    client: httpx.AsyncClient = app.state.http
+
+    plan: List[Tuple[int, str, str]] = []
+
+    for i in range(0, len(file_ids), BITRIX_BATCH_LIMIT):
+        chunk = file_ids[i:i + BITRIX_BATCH_LIMIT]
+        params: Dict[str, Any] = {"halt": 0}
+        for file_id in chunk:
+            params[f"cmd[f{file_id}]"] = f"disk.file.get?id={file_id}"
+
+        async def fetch_batch() -> httpx.Response:
+            resp = await client.post(f"{base}/batch.json", data=params)
+            resp.raise_for_status()
+            return resp
+
+        resp = await with_retry(fetch_batch)
+        data = orjson.loads(resp.content)
+
+        batch_result = data.get("result") or {}
+        results = batch_result.get("result") or {}
+        errors = batch_result.get("result_error") or {}
+        # o Bitrix devolve [] em vez de {} quando a lista está vazia
+        if not isinstance(results, dict):
+            results = {}
+        if not isinstance(errors, dict):
+            errors = {}
+
+        for file_id in chunk:
+            file_info = results.get(f"f{file_id}") or {}
+            filename = file_info.get("NAME") or f"bitrix_file_{file_id}"
+            download_url = file_info.get("DOWNLOAD_URL")
+
+            error = errors.get(f"f{file_id}")
+            if error:
+                print(f"[WARN] Bitrix devolveu erro para o ficheiro {file_id}: {error}")
+                continue
 
-    # 1) Buscar metadados do ficheiro
-    url_meta = f"{base}/disk.file.get.json"
-    params = {"id": file_id}
+            if not download_url:
+                print(f"[WARN] Bitrix não devolveu DOWNLOAD_URL para o ficheiro {file_id}")
+                continue
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.get(url_meta, params=params)
-        resp.raise_for_status()
-        data = resp.json()
+            plan.append((file_id, download_url, filename))
 
-    file_info = data.get("result") or {}
-    filename = file_info.get("NAME") or f"bitrix_file_{file_id}"
-    download_url = file_info.get("DOWNLOAD_URL")
+    return plan
 
-    if not download_url:
-        raise HTTPException(502, f"Bitrix não devolveu DOWNLOAD_URL para o ficheiro {file_id}")
 
-    # 2) Download real do ficheiro (URL já autenticada pelo webhook)
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        file_resp = await client.get(download_url)
+@asynccontextmanager
+async def download_bitrix_file(download_url: str) -> AsyncIterator[Tuple[AsyncIterator[bytes], str]]:
+    """
+    Abre o download de um ficheiro do Bitrix (DOWNLOAD_URL já autenticada pelo webhook).
+    Devolve (chunks, content_type); o conteúdo é lido em streaming
+    enquanto o contexto estiver aberto.
+    """
+    client: httpx.AsyncClient = app.state.http
+    async with client.stream("GET", download_url, timeout=60.0) as file_resp:
         file_resp.raise_for_status()
-        file_bytes = file_resp.content
         content_type = file_resp.headers.get("content-type", "application/octet-stream")
-
-    return file_bytes, content_type, filename
+        yield file_resp.aiter_bytes(), content_type
 
 
 # -------------------------------------------------
 #  Helper R2
 # -------------------------------------------------
 
-def upload_to_r2(file_bytes: bytes, filename: str, content_type: str | None = None) -> str:
+async def run_r2(fn: Callable[..., T], **kwargs: Any) -> T:
+    """Corre uma chamada bloqueante do boto3 no executor dedicado ao R2."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.r2_executor, functools.partial(fn, **kwargs))
+
+
+def r2_public_url(key: str) -> str:
+    """
+    URL público de um objeto no R2, com a chave percent-encoded
+    (nomes com espaços, acentos, '#' ou '?' continuam a apontar para o ficheiro).
+    """
+    return f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{quote(key)}"
+
+
+async def upload_to_r2(file_bytes: bytes, filename: str, content_type: str | None = None) -> str:
     """
     Envia ficheiro para o bucket R2 e devolve URL público.
+    A chave leva o SHA-256 do conteúdo (attachments/ab/<sha>/nome), por isso
+    um ficheiro igual já enviado não é enviado outra vez.
+    O put_object do boto3 é bloqueante, por isso corre numa thread.
     """
-    if not all([R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_ACCOUNT_ID, R2_BUCKET_NAME, R2_PUBLIC_BASE_URL]):
-        raise HTTPException(500, "Configuração R2 incompleta.")
+    r2_client = app.state.r2
+
+    # pasta /attachments dentro do bucket, com o hash do conteúdo no caminho
+    # para que o mesmo ficheiro não seja enviado duas vezes
+    digest = hashlib.sha256(file_bytes).hexdigest()
+    key = f"attachments/{digest[:2]}/{digest}/{filename}"
+
+    try:
+        await run_r2(r2_client.head_object, Bucket=R2_BUCKET_NAME, Key=key)
+        exists = True
+    except ClientError:
+        exists = False
+
+    if not exists:
+        await run_r2(
+            r2_client.put_object,
+            Bucket=R2_BUCKET_NAME,
+            Key=key,
+            Body=io.BytesIO(file_bytes),
+            ContentType=content_type or "application/octet-stream",
+        )
+
+    # Public Development URL, ex.: https://pub-xxxx.r2.dev/attachments/ab/ab12.../ficheiro.pdf
+    return r2_public_url(key)
+
+
+async def upload_stream_to_r2(
+    chunks: AsyncIterator[bytes],
+    filename: str,
+    content_type: str | None = None,
+) -> str:
+    """
+    Envia para o R2 um ficheiro recebido em streaming e devolve URL público.
+    Ficheiros pequenos vão num único put_object (upload_to_r2, com dedup
+    pelo hash); os restantes em multipart, com as partes a subir enquanto o
+    download continua. Nestes o hash só se conhece no fim, por isso vão para
+    attachments/<uuid>/nome e não há dedup.
+    """
+    r2_client = app.state.r2
 
-    # pasta /attachments dentro do bucket
-    key = f"attachments/{filename}"
+    it = chunks.__aiter__()
+    buffer = bytearray()
 
-    r2_client.put_object(
+    while len(buffer) < R2_PART_SIZE:
+        chunk = await anext(it, None)
+        if chunk is None:
+            return await upload_to_r2(bytes(buffer), filename, content_type)
+        buffer += chunk
+
+    # chave única por upload: ficheiros com o mesmo nome não se sobrepõem
+    key = f"attachments/{uuid.uuid4().hex}/{filename}"
+
+    mpu = await run_r2(
+        r2_client.create_multipart_upload,
         Bucket=R2_BUCKET_NAME,
         Key=key,
-        Body=file_bytes,
         ContentType=content_type or "application/octet-stream",
     )
+    upload_id = mpu["UploadId"]
+
+    async def send_part(part_number: int, body: bytes) -> Dict[str, Any]:
+        resp = await run_r2(
+            r2_client.upload_part,
+            Bucket=R2_BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=io.BytesIO(body),
+        )
+        return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+    tasks: List[asyncio.Task] = []
+
+    async def acquire_part_slot() -> None:
+        # limite global de partes em memória (todos os ficheiros juntos);
+        # enquanto não houver vaga, o download deste ficheiro fica parado
+        await r2_parts_semaphore.acquire()
+        # se uma parte falhou, parar já em vez de enviar o resto do ficheiro
+        for t in tasks:
+            if t.done() and not t.cancelled() and t.exception():
+                r2_parts_semaphore.release()
+                raise t.exception()
+
+    def start_part(body: bytes) -> None:
+        task = asyncio.create_task(send_part(len(tasks) + 1, body))
+        # liberta a vaga mesmo que a tarefa seja cancelada antes de arrancar
+        task.add_done_callback(lambda _: r2_parts_semaphore.release())
+        tasks.append(task)
 
-    # Public Development URL, ex.: https://pub-xxxx.r2.dev/attachments/ficheiro.pdf
-    return f"{R2_PUBLIC_BASE_URL.rstrip('/')}/{key}"
+    try:
+        while True:
+            # o R2 exige partes todas do mesmo tamanho (exceto a última)
+            while len(buffer) >= R2_PART_SIZE:
+                await acquire_part_slot()
+                # copia só uma vez (bytearray -> bytes), sem slice intermédio
+                with memoryview(buffer) as view:
+                    body = bytes(view[:R2_PART_SIZE])
+                del buffer[:R2_PART_SIZE]
+                start_part(body)
+
+            chunk = await anext(it, None)
+            if chunk is None:
+                break
+            buffer += chunk
+
+        if buffer:
+            await acquire_part_slot()
+            start_part(bytes(buffer))
+            buffer.clear()
+
+        parts = await asyncio.gather(*tasks)
+
+        await run_r2(
+            r2_client.complete_multipart_upload,
+            Bucket=R2_BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        # também em cancelamento (prazo dos anexos): não deixar multipart pendurado
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await run_r2(
+            r2_client.abort_multipart_upload,
+            Bucket=R2_BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+        )
+        raise
 
+    return r2_public_url(key)
 
-# -------------------------------------------------
-#  Endpoints
-# -------------------------------------------------
 
-@app.get("/healthz")
-async def healthz():
-    return {
-        "ok": bool(LINEAR_API_KEY and LINEAR_TEAM_ID),
-        "has_api_key": bool(LINEAR_API_KEY),
-        "has_team_id": bool(LINEAR_TEAM_ID),
-        "r2_configured": bool(R2_ACCESS_KEY_ID and R2_BUCKET_NAME and R2_PUBLIC_BASE_URL),
-        "bitrix_configured": bool(BITRIX_WEBHOOK_BASE),
-    }
+async def process_attachment(file_id: int, download_url: str, filename: str) -> str | None:
+    """
+    Copia um ficheiro do Bitrix para o R2 em streaming.
+    Devolve o URL público, ou None se falhar.
+    """
+    async with attachment_semaphore:
+        try:
+            async with download_bitrix_file(download_url) as (chunks, content_type):
+                return await upload_stream_to_r2(chunks, filename, content_type)
+        except Exception as e:
+            print(f"[WARN] Falha ao copiar ficheiro {file_id} do Bitrix para o R2: {e}")
+            return None
 
 
-@app.post("/bitrix-linear")
-async def bitrix_linear(request: Request):
+async def copy_bitrix_files_to_r2(file_ids: List[int]) -> List[str]:
     """
-    Webhook para receber eventos do Bitrix24 (ex.: onCrmDealAdd / onCrmDealUpdate)
-    e criar issue no Linear com:
-      - Título            -> FIELDS.TITLE (ou outro fallback)
-      - Descrição         -> FIELDS.COMMENTS
-      - Responsável       -> FIELDS.ASSIGNEE_EMAIL (procura no Linear)
-      - Anexos            -> FIELDS.ATTACHMENT_FILE_IDS (lista de IDs do Disk)
-    Os ficheiros são copiados para o R2 e os links são adicionados na descrição da issue.
+    Copia vários ficheiros do Bitrix para o R2 em paralelo.
+    Os metadados (URL e nome) são resolvidos todos antes, com um pedido
+    batch por cada BITRIX_BATCH_LIMIT ficheiros, para que as tarefas em
+    paralelo sejam só download + upload.
+    Tudo tem de acabar em ATTACHMENT_COPY_DEADLINE segundos; as cópias ainda
+    em curso nessa altura são canceladas, para não atrasar a criação da issue.
+    Devolve os URLs públicos dos ficheiros copiados com sucesso.
+    """
+    if not file_ids:
+        return []
+
+    if not R2_CONFIG_OK:
+        print(f"[WARN] Configuração R2 incompleta; ficheiros {file_ids} ignorados.")
+        return []
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ATTACHMENT_COPY_DEADLINE
+
+    try:
+        plan = await asyncio.wait_for(get_bitrix_files_info(file_ids), ATTACHMENT_COPY_DEADLINE)
+    except Exception as e:
+        print(f"[WARN] Falha ao obter metadados dos ficheiros {file_ids} do Bitrix: {e!r}")
+        return []
+
+    if not plan:
+        return []
+
+    tasks = [
+        asyncio.create_task(process_attachment(file_id, url, filename))
+        for file_id, url, filename in plan
+    ]
+    done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - loop.time()))
+
+    if pending:
+        print(f"[WARN] {len(pending)} anexo(s) não copiados dentro de {ATTACHMENT_COPY_DEADLINE}s; cancelados.")
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    # manter a ordem original dos anexos
+    return [t.result() for t in tasks if t in done and t.result()]
+
+
+# -------------------------------------------------
+#  Bitrix -> Linear
+# -------------------------------------------------
+
+async def process_bitrix_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Cria a issue no Linear a partir do payload do webhook do Bitrix24
+    (copia anexos para o R2, resolve o responsável e cria a issue).
     """
-    payload = await request.json()
     data = payload.get("data") or {}
     fields = data.get("FIELDS") or {}
 
@@ -207,9 +612,21 @@ async def bitrix_linear(request: Request):
     )
     description = original_description
 
-    # Responsável (email do Linear)
+    # Responsável: id do Linear se o Bitrix já o enviar, senão procura pelo email
     assignee_email = fields.get("ASSIGNEE_EMAIL")
-    assignee_id = await get_user_id_by_email(assignee_email) if assignee_email else None
+    given_assignee_id = str(fields.get("ASSIGNEE_ID") or "").strip() or None
+
+    async def resolve_assignee() -> str | None:
+        if given_assignee_id:
+            return given_assignee_id
+        if not assignee_email:
+            return None
+        # uma falha na procura não pode impedir a criação da issue
+        try:
+            return await get_user_id_by_email(assignee_email)
+        except Exception as e:
+            print(f"[WARN] Falha ao procurar responsável {assignee_email} no Linear: {e!r}")
+            return None
 
     # IDs de ficheiros do Bitrix (Disk) enviados pelo Bitrix
     attachment_file_ids = fields.get("ATTACHMENT_FILE_IDS") or []
@@ -224,16 +641,43 @@ async def bitrix_linear(request: Request):
         if s.isdigit():
             normalized_ids.append(int(s))
 
-    # 1) Criar issue no Linear
-    mutation_create = """
-    mutation($input: IssueCreateInput!) {
-      issueCreate(input: $input) {
-        success
-        issue { id identifier title url }
-      }
-    }
-    """
+    # URLs de ficheiros que o cliente já enviou diretamente para o R2
+    attachment_urls = fields.get("ATTACHMENT_URLS") or []
+    if isinstance(attachment_urls, str):
+        attachment_urls = [attachment_urls]
+    attachment_urls = [str(u).strip() for u in attachment_urls if str(u).strip()]
+
+    # só aceitamos links do nosso bucket público, na forma encoded que o
+    # /attachments/presign devolve (sem espaços, para não partir o Markdown)
+    r2_prefix = f"{R2_PUBLIC_BASE_URL.rstrip('/')}/" if R2_PUBLIC_BASE_URL else None
+    accepted_urls: List[str] = []
+    for u in attachment_urls:
+        if r2_prefix and u.startswith(r2_prefix) and not any(c.isspace() for c in u):
+            accepted_urls.append(u)
+        else:
+            print(f"[WARN] URL de anexo fora do R2 ignorado: {u}")
+    attachment_urls = accepted_urls
+
+    # 1) Copiar ficheiros do Bitrix -> R2 e procurar o responsável (em paralelo)
+    # Feito antes de criar a issue para que a descrição já leve os links e
+    # baste um único pedido ao Linear (sem issueUpdate posterior).
+    assignee_id, copied_urls = await asyncio.gather(
+        resolve_assignee(),
+        copy_bitrix_files_to_r2(normalized_ids),
+    )
+    created_attachments: List[str] = attachment_urls + copied_urls
 
+    if created_attachments:
+        anexos_txt = "\n".join(f"- {url}" for url in created_attachments)
+
+        description = (
+            f"{original_description}\n\n"
+            f"---\n"
+            f"Anexos (R2):\n"
+            f"{anexos_txt}"
+        )
+
+    # 2) Criar issue no Linear
     issue_input: Dict[str, Any] = {
         "title": title,
         "description": description,
@@ -242,57 +686,17 @@ async def bitrix_linear(request: Request):
     if assignee_id:
         issue_input["assigneeId"] = assignee_id
 
-    data_create = await linear_request(mutation_create, {"input": issue_input})
+    # issueCreate não é idempotente: só repete quando o pedido não chegou ao Linear
+    data_create = await with_retry(
+        lambda: linear_request(MUT_ISSUE_CREATE, {"input": issue_input}, "CreateIssue"),
+        retryable=is_retryable_mutation_error,
+    )
     issue_create = data_create["issueCreate"]
     issue = issue_create["issue"]
-    issue_id = issue["id"]
-
-    # 2) Copiar ficheiros do Bitrix -> R2
-    created_attachments: List[str] = []
-
-    if normalized_ids:
-        for file_id in normalized_ids:
-            try:
-                file_bytes, content_type, filename = await download_bitrix_file(file_id)
-            except Exception as e:
-                print(f"[WARN] Falha ao descarregar ficheiro {file_id} do Bitrix: {e}")
-                continue
 
-            public_url = upload_to_r2(file_bytes, filename, content_type)
-            created_attachments.append(public_url)
-
-    # 3) Se houver anexos, atualizar descrição da issue com os links
     if created_attachments:
-        anexos_txt = "\n".join(f"- {url}" for url in created_attachments)
-
-        new_description = (
-            f"{original_description}\n\n"
-            f"---\n"
-            f"Anexos (R2):\n"
-            f"{anexos_txt}"
-        )
-
-        mutation_update = """
-        mutation($id: String!, $input: IssueUpdateInput!) {
-          issueUpdate(id: $id, input: $input) {
-            success
-            issue { id }
-          }
-        }
-        """
-
-        await linear_request(
-            mutation_update,
-            {
-                "id": issue_id,
-                "input": {
-                    "description": new_description,
-                },
-            },
-        )
-
         # também devolvemos a descrição final na resposta
-        issue["description"] = new_description
+        issue["description"] = description
 
     return {
         "ok": True,
@@ -302,3 +706,114 @@ async def bitrix_linear(request: Request):
         "attachment_file_ids_received": normalized_ids,
         "attachments": created_attachments,
     }
+
+
+async def process_bitrix_payload_in_background(payload: Dict[str, Any], webhook_key: str) -> None:
+    """
+    Corre o processamento fora do pedido HTTP; os erros ficam apenas no log.
+    Em caso de erro o webhook deixa de contar como visto, para que um
+    reenvio do Bitrix seja processado.
+    """
+    try:
+        result = await process_bitrix_payload(payload)
+        issue = result.get("issue") or {}
+        print(f"[INFO] Issue criada no Linear: {issue.get('identifier')} {issue.get('url')}")
+    except Exception as e:
+        SEEN_WEBHOOKS.pop(webhook_key, None)
+        print(f"[ERROR] Falha ao processar webhook do Bitrix: {e!r}")
+
+
+# -------------------------------------------------
+#  Endpoints
+# -------------------------------------------------
+
+@app.get("/healthz")
+async def healthz():
+    return {
+        "ok": bool(LINEAR_API_KEY and LINEAR_TEAM_ID),
+        "has_api_key": bool(LINEAR_API_KEY),
+        "has_team_id": bool(LINEAR_TEAM_ID),
+        "r2_configured": R2_CONFIG_OK,
+        "bitrix_configured": bool(BITRIX_WEBHOOK_BASE),
+    }
+
+
+@app.post("/attachments/presign")
+async def presign_attachment(request: Request):
+    """
+    Devolve um URL pré-assinado (PUT) para o cliente enviar o ficheiro
+    diretamente para o R2, sem passar por este servidor.
+    Header: X-Presign-Token (igual a PRESIGN_TOKEN)
+    Body: {"filename": "...", "content_type": "..."}
+    Depois do PUT, o public_url deve ser enviado em FIELDS.ATTACHMENT_URLS.
+    """
+    if not R2_CONFIG_OK:
+        raise HTTPException(500, "Configuração R2 incompleta.")
+    if not PRESIGN_TOKEN:
+        raise HTTPException(500, "Falta PRESIGN_TOKEN")
+
+    token = request.headers.get("x-presign-token") or ""
+    if not hmac.compare_digest(token.encode(), PRESIGN_TOKEN.encode()):
+        raise HTTPException(401, "Token inválido")
+
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(400, "JSON inválido")
+    if not isinstance(body, dict):
+        raise HTTPException(400, "O body tem de ser um objeto JSON")
+
+    raw_filename = body.get("filename")
+    content_type = body.get("content_type")
+    if not isinstance(raw_filename, str) or not (content_type is None or isinstance(content_type, str)):
+        raise HTTPException(400, "filename e content_type têm de ser texto")
+
+    filename = os.path.basename(raw_filename.strip())
+    if not filename:
+        raise HTTPException(400, "Falta filename")
+
+    # chave gerada pelo servidor: um URL assinado nunca sobrepõe outro ficheiro
+    key = f"attachments/{uuid.uuid4().hex}/{filename}"
+    params: Dict[str, Any] = {"Bucket": R2_BUCKET_NAME, "Key": key}
+    if content_type:
+        params["ContentType"] = content_type
+
+    upload_url = app.state.r2.generate_presigned_url(
+        "put_object",
+        Params=params,
+        ExpiresIn=R2_PRESIGN_EXPIRES,
+    )
+
+    return {
+        "upload_url": upload_url,
+        "public_url": r2_public_url(key),
+        "expires_in": R2_PRESIGN_EXPIRES,
+    }
+
+
+@app.post("/bitrix-linear", status_code=202)
+async def bitrix_linear(request: Request, background: BackgroundTasks):
+    """
+    Webhook para receber eventos do Bitrix24 (ex.: onCrmDealAdd / onCrmDealUpdate)
+    e criar issue no Linear com:
+      - Título            -> FIELDS.TITLE (ou outro fallback)
+      - Descrição         -> FIELDS.COMMENTS
+      - Responsável       -> FIELDS.ASSIGNEE_ID (id do utilizador no Linear, opcional)
+                             ou FIELDS.ASSIGNEE_EMAIL (procura no Linear)
+      - Anexos            -> FIELDS.ATTACHMENT_URLS (URLs públicos já no R2,
+                             enviados via /attachments/presign)
+                             e/ou FIELDS.ATTACHMENT_FILE_IDS (lista de IDs do Disk)
+    Os ficheiros do Disk são copiados para o R2 e os links são adicionados na descrição da issue.
+    Responde logo com 202; a criação da issue corre em background.
+    """
+    body = await request.body()
+
+    webhook_key = hashlib.sha256(body).hexdigest()
+    if webhook_key in SEEN_WEBHOOKS:
+        return {"ok": True, "accepted": False, "duplicate": True}
+
+    payload = orjson.loads(body)
+    SEEN_WEBHOOKS[webhook_key] = True
+    background.add_task(process_bitrix_payload_in_background, payload, webhook_key)
+
+    return {"ok": True, "accepted": True}